@@ -1,11 +1,12 @@
 """TwitchAuthDb"""
+import asyncio
 import sqlite3
 import threading
 from datetime import datetime
 import typing
 from first.twitch import Twitch, TwitchUserId
 from first.config import cfg
-from first.db import DbBase, Timestamp
+from first.db import DbBase, SQLCode, Timestamp
 from first.errors import UserNotFoundError
 
 Token = str
@@ -19,24 +20,56 @@ class TokenProvider(typing.Protocol):
     def user_id(self) -> TwitchUserId: ...
 
 class TwitchAuthDbUserTokenProvider(TokenProvider):
+    """Provides a user's tokens stored in a TwitchAuthDb.
+
+    The access token is cached after the first lookup. If the cached token
+    is stale (e.g. another provider refreshed it), the API call fails
+    with 401 and AuthenticatedTwitch calls refresh_access_token, which
+    replaces the cached token.
+
+    This object is thread-safe.
+    """
+
+    _lock: threading.Lock
     _authdb: "TwitchAuthDb"
     _user_id: TwitchUserId
 
+    # Protected by _lock:
+    _cached_access_token: typing.Optional[Token] = None
+
     def __init__(self, authdb: "TwitchAuthDb", user_id: TwitchUserId) -> None:
+        self._lock = threading.Lock()
         self._authdb = authdb
         self._user_id = user_id
 
     def get_access_token(self) -> Token:
-        return self._authdb.get_access_token(self._user_id)
+        with self._lock:
+            access_token = self._cached_access_token
+        if access_token is None:
+            access_token = self._authdb.get_access_token(self._user_id)
+            with self._lock:
+                if self._cached_access_token is None:
+                    self._cached_access_token = access_token
+        return access_token
 
     def refresh_access_token(self) -> Token:
-        refresh_result = Twitch().refresh_auth_token(self._authdb.get_refresh_token(self._user_id))
-        self._authdb.update_or_create_user(
+        old_refresh_token = self._authdb.get_refresh_token(self._user_id)
+        refresh_result = Twitch().refresh_auth_token(old_refresh_token)
+        swapped = self._authdb.swap_tokens(
             user_id=self._user_id,
-            access_token=refresh_result.new_access_token,
-            refresh_token=refresh_result.new_refresh_token,
+            old_refresh_token=old_refresh_token,
+            new_access_token=refresh_result.new_access_token,
+            new_refresh_token=refresh_result.new_refresh_token,
         )
-        return refresh_result.new_access_token
+        if swapped:
+            access_token = refresh_result.new_access_token
+        else:
+            # Someone else refreshed while we were talking to Twitch. Use
+            # their tokens so that we agree with the database.
+            access_token = self._authdb.get_access_token(self._user_id)
+        with self._lock:
+            self._cached_access_token = access_token
+        return access_token
 
     @property
     def user_id(self) -> TwitchUserId:
@@ -58,100 +91,202 @@ class TwitchAppTokenProvider(TokenProvider):
         return None
 
 class TwitchAuthDb(DbBase):
+    _SQL_UPSERT_USER: SQLCode = (
+        "INSERT INTO twitch_tokens (user_id, access_token, refresh_token) VALUES(?, ?, ?) "
+        "ON CONFLICT (user_id) "
+        "DO UPDATE SET access_token = excluded.access_token, refresh_token = excluded.refresh_token"
+    )
+    _SQL_SWAP_TOKENS: SQLCode = "UPDATE twitch_tokens SET access_token = ?, refresh_token = ? WHERE user_id = ? AND refresh_token = ?"
+    _SQL_GET_ACCESS_TOKEN: SQLCode = "SELECT access_token FROM twitch_tokens WHERE user_id = ?"
+    _SQL_GET_REFRESH_TOKEN: SQLCode = "SELECT refresh_token FROM twitch_tokens WHERE user_id = ?"
+    _SQL_GET_ALL_USER_IDS: SQLCode = "SELECT user_id FROM twitch_tokens"
+
     def __init__(self, db=authdb_config["db"]):
         super().__init__()
         self._create_sqlite3_database(db)
+        # Autocommit mode. Writers open their own transactions with BEGIN
+        # IMMEDIATE.
+        self.db.isolation_level = None
         cur = self.db.cursor()
-        cur.execute(
-            (
-                "CREATE TABLE IF NOT EXISTS "
-                "twitch_tokens("
-                    "user_id UNIQUE, "
-                    "access_token, "
-                    "refresh_token, "
-                    f"{self._created_at_and_updated_at_column_definitions_sql()}"
-                ")"
-            )
+        # WAL lets readers (see NOTE[DbBase-read-pool]) proceed while a write
+        # is in progress.
+        cur.executescript(
+            "PRAGMA journal_mode=WAL; "
+            "PRAGMA synchronous=NORMAL; "
+            "PRAGMA busy_timeout=5000; "
+            "PRAGMA temp_store=MEMORY;"
+        )
+        self._migrate_twitch_tokens_table()
+        cur.execute(self._create_twitch_tokens_table_sql(table_name="twitch_tokens"))
+        self._create_updated_at_trigger(table_name="twitch_tokens", unix_time=True, key_column="user_id")
+        self._create_sqlite3_read_pool(db, size=authdb_config.get("read_pool_size", 5))
+
+    def _create_twitch_tokens_table_sql(self, table_name: str) -> SQLCode:
+        return (
+            "CREATE TABLE IF NOT EXISTS "
+            f"{table_name}("
+                "user_id TEXT PRIMARY KEY NOT NULL, "
+                "access_token, "
+                "refresh_token, "
+                f"{self._unix_time_created_at_and_updated_at_column_definitions_sql()}"
+            # Store rows in user_id order so that a lookup by user_id searches
+            # the table itself rather than a separate index.
+            ") WITHOUT ROWID"
         )
-        self._create_updated_at_trigger(table_name="twitch_tokens")
 
+    def _migrate_twitch_tokens_table(self) -> None:
+        """Rebuild a twitch_tokens table created by an older version:
+
+        * 'user_id UNIQUE' becomes the PRIMARY KEY of a WITHOUT ROWID table.
+        * created_at and updated_at CURRENT_TIMESTAMP text becomes integer
+          Unix timestamps.
+
+        If twitch_tokens does not exist or is already migrated, this function
+        does nothing.
+        """
+        cur = self.db.cursor()
+        row = cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'twitch_tokens'").fetchone()
+        if row is None:
+            return
+        table_sql, = row
+        is_without_rowid = "WITHOUT ROWID" in table_sql.upper()
+        columns = cur.execute("PRAGMA table_info(twitch_tokens)").fetchall()
+        # Columns of table_info: cid, name, type, notnull, dflt_value, pk
+        timestamps_are_integers = any(name == "created_at" and column_type == "INTEGER" for _cid, name, column_type, _notnull, _dflt_value, _pk in columns)
+        if is_without_rowid and timestamps_are_integers:
+            return
+        def unix_time_sql(column: str) -> SQLCode:
+            return f"CASE WHEN typeof({column}) = 'text' THEN CAST(strftime('%s', {column}) AS INTEGER) ELSE {column} END"
+        # DROP TABLE also drops the old updated_at trigger.
+        try:
+            cur.executescript(
+                "BEGIN IMMEDIATE; "
+                f"{self._create_twitch_tokens_table_sql(table_name='twitch_tokens_new')}; "
+                "INSERT INTO twitch_tokens_new (user_id, access_token, refresh_token, created_at, updated_at) "
+                    f"SELECT user_id, access_token, refresh_token, {unix_time_sql('created_at')}, {unix_time_sql('updated_at')} FROM twitch_tokens "
+                    "WHERE user_id IS NOT NULL; "
+                "DROP TABLE twitch_tokens; "
+                "ALTER TABLE twitch_tokens_new RENAME TO twitch_tokens; "
+                "COMMIT;"
+            )
+        except BaseException:
+            if self.db.in_transaction:
+                cur.execute("ROLLBACK")
+            raise
 
     def update_or_create_user(self, user_id: TwitchUserId, access_token: Token, refresh_token: Token):
         """
         If user does not exist it creates a new one.
         If it exists, it just updates the tokens.
         """
+        self.update_or_create_users([(user_id, access_token, refresh_token)])
+
+    def update_or_create_users(self, rows: typing.Iterable[typing.Tuple[TwitchUserId, Token, Token]]):
+        """Like update_or_create_user, but for many users at once.
+
+        Each row is (user_id, access_token, refresh_token). All rows are
+        written in a single transaction.
+        """
         with self._lock:
-            cur = self.db.cursor()
-            data = {
-                "user_id": user_id,
-                "access_token": access_token,
-                "refresh_token": refresh_token,
-            }
-            cur.execute(
-                (
-                    "INSERT INTO twitch_tokens (user_id, access_token, refresh_token) VALUES(:user_id, :access_token, :refresh_token) "
-                    "ON CONFLICT (user_id) "
-                    "DO UPDATE SET access_token = :access_token, refresh_token = :refresh_token"
-                ), data)
-
-            self.db.commit()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(self._SQL_UPSERT_USER, rows)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
 
-    def get_access_token(self, user_id: TwitchUserId) -> Token:
+    def swap_tokens(self, user_id: TwitchUserId, old_refresh_token: Token, new_access_token: Token, new_refresh_token: Token) -> bool:
+        """Replace the user's tokens if their refresh token is still
+        old_refresh_token.
+
+        Returns False and changes nothing if the user does not exist or if
+        their refresh token was changed (e.g. by a concurrent refresh).
+        """
         with self._lock:
-            cur = self.db.cursor()
-            data = {
-                "user_id": user_id,
-            }
-            result = cur.execute("SELECT access_token FROM twitch_tokens WHERE user_id = :user_id", data)
-            result_fetched = result.fetchone()
-        if result_fetched is None:
+            # A single statement in autocommit mode is its own transaction.
+            result = self.db.execute(self._SQL_SWAP_TOKENS, (new_access_token, new_refresh_token, user_id, old_refresh_token))
+            return result.rowcount == 1
+
+    def get_access_token(self, user_id: TwitchUserId) -> Token:
+        with self._read_connection() as db:
+            row = db.execute(self._SQL_GET_ACCESS_TOKEN, (user_id,)).fetchone()
+        if row is None:
             raise UserNotFoundError
-        access_token, = result_fetched
-        return access_token
+        return row[0]
 
     def get_refresh_token(self, user_id: TwitchUserId) -> Token:
-        with self._lock:
-            cur = self.db.cursor()
-            data = {
-                "user_id": user_id,
-            }
-            result = cur.execute("SELECT refresh_token FROM twitch_tokens WHERE user_id = :user_id", data)
-            result_fetched = result.fetchone()
-        if result_fetched is None:
+        with self._read_connection() as db:
+            row = db.execute(self._SQL_GET_REFRESH_TOKEN, (user_id,)).fetchone()
+        if row is None:
             raise UserNotFoundError
-        refresh_token, = result_fetched
-        return refresh_token
+        return row[0]
 
-    def get_all_user_ids_slow(self) -> typing.List[TwitchUserId]:
-        user_ids = []
-        with self._lock:
-            cur = self.db.cursor()
-            result = cur.execute("SELECT user_id FROM twitch_tokens")
-            while True:
-                rows = result.fetchmany()
-                if not rows:
-                    break
-                for (user_id,) in rows:
-                    user_ids.append(user_id)
-        return user_ids
+    def iter_user_ids(self) -> typing.Iterator[TwitchUserId]:
+        """Yield the user ID of every user in the database.
+
+        The generator holds a database connection until it is exhausted or
+        closed. With an in-memory database, that connection is the locked
+        writer connection, so do not call other methods of this object while
+        iterating. (See NOTE[DbBase-read-pool].)
+        """
+        with self._read_connection() as db:
+            for (user_id,) in db.execute(self._SQL_GET_ALL_USER_IDS):
+                yield user_id
+
+    def get_all_user_ids(self) -> typing.List[TwitchUserId]:
+        return list(self.iter_user_ids())
 
     def get_created_at_time(self, user_id: TwitchUserId) -> Timestamp:
         created_at, _updated_at = self._get_created_at_and_updated_at(
             table_name="twitch_tokens",
-            where_clause="WHERE user_id = :user_id",
-            parameters={
-                "user_id": user_id,
-            },
+            where_clause="WHERE user_id = ?",
+            parameters=(user_id,),
         )
         return created_at
 
     def get_updated_at_time(self, user_id: TwitchUserId) -> Timestamp:
         _created_at, updated_at = self._get_created_at_and_updated_at(
             table_name="twitch_tokens",
-            where_clause="WHERE user_id = :user_id",
-            parameters={
-                "user_id": user_id,
-            },
+            where_clause="WHERE user_id = ?",
+            parameters=(user_id,),
         )
         return updated_at
+
+class AsyncTwitchAuthDb:
+    """Coroutine interface to a TwitchAuthDb.
+
+    Each call runs the corresponding TwitchAuthDb method on a worker thread
+    (asyncio.to_thread) so that SQLite does not block the event loop.
+
+    This object is thread-safe.
+    """
+
+    _sync: TwitchAuthDb
+
+    def __init__(self, authdb: TwitchAuthDb) -> None:
+        self._sync = authdb
+
+    async def update_or_create_user(self, user_id: TwitchUserId, access_token: Token, refresh_token: Token) -> None:
+        await asyncio.to_thread(self._sync.update_or_create_user, user_id, access_token, refresh_token)
+
+    async def update_or_create_users(self, rows: typing.Iterable[typing.Tuple[TwitchUserId, Token, Token]]) -> None:
+        await asyncio.to_thread(self._sync.update_or_create_users, rows)
+
+    async def swap_tokens(self, user_id: TwitchUserId, old_refresh_token: Token, new_access_token: Token, new_refresh_token: Token) -> bool:
+        return await asyncio.to_thread(self._sync.swap_tokens, user_id, old_refresh_token, new_access_token, new_refresh_token)
+
+    async def get_access_token(self, user_id: TwitchUserId) -> Token:
+        return await asyncio.to_thread(self._sync.get_access_token, user_id)
+
+    async def get_refresh_token(self, user_id: TwitchUserId) -> Token:
+        return await asyncio.to_thread(self._sync.get_refresh_token, user_id)
+
+    async def get_all_user_ids(self) -> typing.List[TwitchUserId]:
+        return await asyncio.to_thread(self._sync.get_all_user_ids)
+
+    async def get_created_at_time(self, user_id: TwitchUserId) -> Timestamp:
+        return await asyncio.to_thread(self._sync.get_created_at_time, user_id)
+
+    async def get_updated_at_time(self, user_id: TwitchUserId) -> Timestamp:
+        return await asyncio.to_thread(self._sync.get_updated_at_time, user_id)
@@ -1,4 +1,7 @@
+import contextlib
 import datetime
+import pathlib
+import queue
 import sqlite3
 import threading
 import typing
@@ -8,11 +11,19 @@ SQLTableName = str
 
 Timestamp = datetime.datetime
 
+# SQLite's CURRENT_TIMESTAMP is in UTC but has no time zone suffix.
+_UTC = datetime.timezone.utc
+
+# The current time as an integer Unix timestamp (seconds). Equivalent to
+# unixepoch(), which requires SQLite 3.38.
+_UNIX_TIME_NOW_SQL: SQLCode = "CAST(strftime('%s', 'now') AS INTEGER)"
+
 class DbBase:
     """Base class for SQLite3 repository classes with useful helpers.
 
     Implemented helpers:
     * locking for thread safety (opt-in)
+    * a pool of read-only connections (opt-in)
     * created-at and updated-at columns (opt-in)
     """
 
@@ -26,6 +37,12 @@ class DbBase:
 
     db: sqlite3.Connection
 
+    # NOTE[DbBase-read-pool]: Read-only connections which are not protected by
+    # __lock. Each connection is used by at most one thread at a time (whoever
+    # took it out of the queue). None if the pool is disabled, in which case
+    # reads go through self.db.
+    _read_pool: "typing.Optional[queue.Queue[sqlite3.Connection]]" = None
+
     def __init__(self) -> None:
         self._lock = threading.Lock()
 
@@ -43,6 +60,45 @@ class DbBase:
             check_same_thread=False,
         )
 
+    def _create_sqlite3_read_pool(self, path: str, size: int) -> None:
+        """Open size read-only connections to an existing database file.
+
+        Call this after _create_sqlite3_database and after creating tables.
+
+        If path is ":memory:" or size is 0, no pool is created. (Separate
+        connections to ":memory:" would each see a different database.)
+
+        See NOTE[DbBase-read-pool].
+        """
+        if path == ":memory:" or size <= 0:
+            return
+        uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+        self._read_pool = queue.Queue()
+        for _ in range(size):
+            self._read_pool.put(sqlite3.connect(
+                uri,
+                uri=True,
+                # See NOTE[DbBase-read-pool].
+                check_same_thread=False,
+            ))
+
+    @contextlib.contextmanager
+    def _read_connection(self) -> typing.Iterator[sqlite3.Connection]:
+        """Borrow a connection for read-only queries.
+
+        If the read pool is enabled, this waits for a free pooled connection
+        and does not take __lock. Otherwise, this locks and yields self.db.
+        """
+        if self._read_pool is None:
+            with self._lock:
+                yield self.db
+            return
+        connection = self._read_pool.get()
+        try:
+            yield connection
+        finally:
+            self._read_pool.put(connection)
+
     def _created_at_and_updated_at_column_definitions_sql(self) -> SQLCode:
         """SQL syntax in CREATE TABLE to make two columns: 'created_at' and
         'updated_at'.
@@ -52,12 +108,29 @@ class DbBase:
             "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
         )
 
-    def _create_updated_at_trigger(self, table_name: SQLTableName) -> SQLCode:
+    def _unix_time_created_at_and_updated_at_column_definitions_sql(self) -> SQLCode:
+        """Like _created_at_and_updated_at_column_definitions_sql, but the
+        columns hold integer Unix timestamps (seconds) instead of text.
+
+        Use with _create_updated_at_trigger(unix_time=True).
+        """
+        return (
+            f"created_at INTEGER DEFAULT ({_UNIX_TIME_NOW_SQL}), "
+            f"updated_at INTEGER DEFAULT ({_UNIX_TIME_NOW_SQL})"
+        )
+
+    def _create_updated_at_trigger(self, table_name: SQLTableName, unix_time: bool = False, key_column: str = "rowid") -> SQLCode:
         """Create a trigger to update updated_at when any row changes in the
         given table.
 
-        Precondition: The table has a rowid (i.e. WITHOUT ROWID was not specified).
+        If unix_time is True, updated_at is set to an integer Unix timestamp.
+        Otherwise, it is set to CURRENT_TIMESTAMP.
+
+        key_column identifies the changed row. The default, "rowid", requires
+        that the table has a rowid (i.e. WITHOUT ROWID was not specified). For
+        a WITHOUT ROWID table, pass its single-column PRIMARY KEY.
         """
+        now_sql = _UNIX_TIME_NOW_SQL if unix_time else "CURRENT_TIMESTAMP"
         with self._lock:
             cur = self.db.cursor()
             cur.execute(
@@ -66,16 +139,21 @@ class DbBase:
                     f"  AFTER UPDATE ON {table_name} FOR EACH ROW"
                     "  WHEN OLD.updated_at = NEW.updated_at OR OLD.updated_at IS NULL"
                     " BEGIN"
-                    f"   UPDATE {table_name} SET updated_at=CURRENT_TIMESTAMP WHERE rowid=NEW.rowid;"
+                    f"   UPDATE {table_name} SET updated_at={now_sql} WHERE {key_column}=NEW.{key_column};"
                     " END;"
                 )
             )
 
-    def _get_created_at_and_updated_at(self, table_name: SQLTableName, where_clause: SQLCode, parameters: typing.Dict) -> typing.Tuple[Timestamp, Timestamp]:
-        with self._lock:
-            cur = self.db.cursor()
-            result = cur.execute(f"SELECT created_at, updated_at FROM {table_name} {where_clause}", parameters)
-            created_at, updated_at = result.fetchone()
-        created_at = datetime.datetime.fromisoformat(created_at + "Z")
-        updated_at = datetime.datetime.fromisoformat(updated_at + "Z")
-        return created_at, updated_at
+    def _get_created_at_and_updated_at(self, table_name: SQLTableName, where_clause: SQLCode, parameters: typing.Union[typing.Sequence, typing.Dict]) -> typing.Tuple[Timestamp, Timestamp]:
+        with self._read_connection() as db:
+            created_at, updated_at = db.execute(f"SELECT created_at, updated_at FROM {table_name} {where_clause}", parameters).fetchone()
+        return _timestamp_from_sql(created_at), _timestamp_from_sql(updated_at)
+
+def _timestamp_from_sql(value: typing.Union[int, str]) -> Timestamp:
+    """Convert a created_at or updated_at column value into a Timestamp.
+
+    value is either an integer Unix timestamp or CURRENT_TIMESTAMP text.
+    """
+    if isinstance(value, int):
+        return datetime.datetime.fromtimestamp(value, tz=_UTC)
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=_UTC)
@@ -1,12 +1,20 @@
 from first.twitch import AuthenticatedTwitch, TwitchUserId
-import json
+import asyncio
+import concurrent.futures
 import logging
+import random
+import requests
 import threading
 import typing
 import websockets
-import websockets.sync.client
+import websockets.asyncio.client
 import datetime
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 logger = logging.getLogger(__name__)
 
 class TwitchEventSubDelegate(typing.Protocol):
@@ -145,24 +153,92 @@ class TwitchEventSubWebSocketThreadBase:
         with self._lock:
             return self._last_received_message_timestamp
 
+# Twitch puts "metadata" (containing "message_type") at the start of every
+# message, so only the start of a message needs to be searched.
+_MESSAGE_TYPE_SEARCH_LENGTH = 256
+_SESSION_KEEPALIVE_MARKERS_STR = ('"message_type":"session_keepalive"', '"message_type": "session_keepalive"')
+_SESSION_KEEPALIVE_MARKERS_BYTES = tuple(marker.encode("utf-8") for marker in _SESSION_KEEPALIVE_MARKERS_STR)
+
+def _looks_like_session_keepalive(message: typing.Union[str, bytes]) -> bool:
+    """Recognize session_keepalive messages without parsing JSON.
+
+    Keepalives are the most frequent messages and carry nothing we use.
+    A false negative is harmless: the message is parsed normally.
+    """
+    markers = _SESSION_KEEPALIVE_MARKERS_STR if isinstance(message, str) else _SESSION_KEEPALIVE_MARKERS_BYTES
+    start = message[:_MESSAGE_TYPE_SEARCH_LENGTH]
+    return any(marker in start for marker in markers)
+
+class _SubscriptionRequestError(Exception):
+    """A Twitch API request to create an EventSub subscription failed."""
+
+class _EventLoopThread:
+    """A Python thread running an asyncio event loop.
+
+    The thread is started lazily by the first call to get_loop.
+
+    This object is thread-safe.
+    """
+
+    _lock: threading.Lock
+
+    # Protected by _lock:
+    _loop: typing.Optional[asyncio.AbstractEventLoop] = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                # Daemon so that a forgotten connection does not keep the
+                # process alive.
+                thread = threading.Thread(target=loop.run_forever, name="TwitchEventSub", daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+# Shared by all TwitchEventSubWebSocketThread-s.
+_eventsub_event_loop_thread = _EventLoopThread()
+
 class TwitchEventSubWebSocketThread(TwitchEventSubWebSocketThreadBase):
     """A single WebSocket connection for Twitch's EventSub API.
 
+    Despite the name, the connection does not get its own Python thread.
+    It runs as an asyncio task on an event loop shared by all connections.
+    Blocking work (Twitch API requests and delegate calls) is moved off
+    the event loop with asyncio.to_thread.
+
     This object is thread-safe.
 
     Documentation for the websockets package:
-    https://websockets.readthedocs.io/en/stable/reference/sync/client.html
+    https://websockets.readthedocs.io/en/stable/reference/asyncio/client.html
     """
 
     _websocket_uri: str
 
+    # Protected by _lock until start_thread. Afterwards, a tuple which is
+    # never reassigned, so it can be read without _lock.
+    _subscriptions: "typing.Union[typing.List[_Subscription], typing.Tuple[_Subscription, ...]]"
+
+    # Assigned by start_thread. Never reassigned afterwards, so it can be
+    # read without _lock. Request bodies for _subscriptions, minus
+    # "transport" which depends on the session.
+    _subscription_request_body_templates: typing.Tuple[typing.Dict[str, typing.Any], ...] = ()
+
     # Protected by _lock:
-    _subscriptions: "typing.List[_Subscription]"
-    _thread: typing.Optional[threading.Thread] = None
+    _loop: typing.Optional[asyncio.AbstractEventLoop] = None
+    _future: typing.Optional[concurrent.futures.Future] = None
     _should_stop: bool = False
 
-    # Protected by _lock; assignable only by background thread:
-    _client: typing.Optional[websockets.sync.client.ClientConnection] = None
+    # Protected by _lock; assignable only by the task:
+    _task: typing.Optional[asyncio.Task] = None
+
+    # Accessed only by the task. Reset once all subscriptions are requested.
+    _consecutive_failures: int = 0
+
+    _max_reconnect_delay_seconds: float = 30
 
     def __init__(self, twitch: AuthenticatedTwitch, delegate: TwitchEventSubDelegate, websocket_uri: str = "wss://eventsub.wss.twitch.tv/ws") -> None:
         super().__init__(twitch, delegate)
@@ -177,124 +253,143 @@ class TwitchEventSubWebSocketThread(TwitchEventSubWebSocketThreadBase):
     def add_subscription(self, type: str, version: str, condition) -> None:
         """Add an EventSub subscription when the WebSocket connects.
 
-        Precondition: The thread must not be running. (Dynamic
+        Precondition: The connection must not be running. (Dynamic
         subscriptions are not yet implemented.)
         """
         with self._lock:
-            if self._thread is not None:
-                raise NotImplemented("dynamic subscriptions are not yet implemented")
+            if self._future is not None:
+                raise NotImplementedError("dynamic subscriptions are not yet implemented")
             self._subscriptions.append(self._Subscription(type=type, version=version, condition=condition))
 
     def start_thread(self) -> None:
-        """Start a Python thread which connects to Twitch EventSub.
+        """Start an asyncio task which connects to Twitch EventSub.
 
         Precondition: There must have been at least one subscription
         registered with add_subscription.
 
-        Precondition: The thread must not be running.
+        Precondition: The task must not be running.
         """
         with self._lock:
             assert self._subscriptions, "at least one subscription is required"
-            assert self._thread is None or not self._thread.is_alive(), "thread must not be already running"
-            self._thread = threading.Thread(target=self._run_thread)
-            self._thread.start()
+            assert self._future is None or self._future.done(), "task must not be already running"
+            # add_subscription refuses to add subscriptions from now on.
+            self._subscriptions = tuple(self._subscriptions)
+            self._subscription_request_body_templates = tuple(
+                {
+                    "type": subscription.type,
+                    "version": subscription.version,
+                    "condition": subscription.condition,
+                }
+                for subscription in self._subscriptions
+            )
+            self._loop = _eventsub_event_loop_thread.get_loop()
+            self._future = asyncio.run_coroutine_threadsafe(self._run(), self._loop)
 
     def stop_thread(self) -> None:
-        """Stop the Python thread which connects to Twitch EventSub.
+        """Stop the asyncio task which connects to Twitch EventSub, and wait
+        for it to finish.
+
+        If the task is not running, this function does nothing.
 
-        If the thread is not running, this function does nothing.
+        Must not be called from the event loop's thread.
         """
         logger.info("stopping thread...")
         with self._lock:
             self._should_stop = True
-
-            client = self._client
-        if client is not None:
-            # This should raise websockets.ConnectionClosedOK on the
-            # running thread.
-            # TODO(strager): Untested.
-            client.close()
-
-        with self._lock:
-            thread = self._thread
-        if thread is not None:
-            thread.join()
-
-    def _run_thread(self) -> None:
-        while True:
-            client = self._maybe_create_client()
-            if client is None:
-                # The user asked us to stop.
-                break
-            try:
-                self._handle_client(client)
-            finally:
-                client.close()
-                with self._lock:
-                    self._client = None
-
-    def _maybe_create_client(self) -> None:
+            task = self._task
+            future = self._future
+            loop = self._loop
+        if task is not None:
+            # This raises asyncio.CancelledError inside the task, which
+            # closes the WebSocket.
+            loop.call_soon_threadsafe(task.cancel)
+        if future is not None:
+            concurrent.futures.wait([future])
+
+    async def _run(self) -> None:
         with self._lock:
-            assert self._client is None
             if self._should_stop:
-                return None
-
-        client = websockets.sync.client.connect(self._websocket_uri)
-
-        with self._lock:
-            self._last_connected_timestamp = datetime.datetime.now()
-            assert self._client is None
-            if self._should_stop:
-                # The user asked us to stop while we were connecting.
-                client.close()
-                return None
-            self._client = client
-
-        return client
-
-    def _handle_client(self, client: websockets.sync.client.ClientConnection) -> None:
-        while True:
-            try:
-                message = client.recv()
-            except websockets.ConnectionClosedOK:
-                logger.info("WebSocket disconnected")
-                # TODO(strager): Backoff.
+                # The user asked us to stop before we started.
                 return
-            except websockets.ConnectionClosedError:
-                logger.info("WebSocket closed with an error", exc_info=True)
-                # FIXME(strager): What should we do here?
-                return
-            self._handle_raw_message(message)
+            self._task = asyncio.current_task()
+        try:
+            while True:
+                with self._lock:
+                    if self._should_stop:
+                        break
+                try:
+                    client = await websockets.asyncio.client.connect(self._websocket_uri)
+                except (OSError, websockets.InvalidHandshake):
+                    logger.info("failed to connect to EventSub", exc_info=True)
+                else:
+                    async with client:
+                        with self._lock:
+                            self._last_connected_timestamp = datetime.datetime.now()
+                        try:
+                            await self._handle_client(client)
+                        except _SubscriptionRequestError:
+                            # Twitch closes sessions which have no
+                            # subscriptions, so start over with a new session.
+                            logger.warning("failed to request EventSub subscriptions; reconnecting", exc_info=True)
+                await asyncio.sleep(self._next_reconnect_delay_seconds())
+        except Exception:
+            logger.error("EventSub connection failed", exc_info=True)
+            raise
 
-    def _handle_raw_message(self, message: typing.Union[str, bytes]) -> None:
-        if isinstance(message, str):
-            # TODO(strager): What should we do on JSON parse error?
-            self._handle_json_message(json.loads(message))
-        else:
-            raise TypeError(f"unsupported message type: {type(message)}")
+    def _next_reconnect_delay_seconds(self) -> float:
+        """Exponential backoff with jitter, so that an outage does not turn
+        into a reconnect loop.
+        """
+        delay = min(self._max_reconnect_delay_seconds, 2 ** self._consecutive_failures) + random.random()
+        self._consecutive_failures += 1
+        return delay
 
-    def _handle_json_message(self, message) -> None:
+    async def _handle_client(self, client: websockets.asyncio.client.ClientConnection) -> None:
+        try:
+            async for message in client:
+                await self._handle_raw_message(message)
+        except websockets.ConnectionClosedError:
+            logger.info("WebSocket closed with an error", exc_info=True)
+            # FIXME(strager): What should we do here?
+            return
+        logger.info("WebSocket disconnected")
+
+    async def _handle_raw_message(self, message: typing.Union[str, bytes]) -> None:
+        if _looks_like_session_keepalive(message):
+            with self._lock:
+                self._last_received_message_timestamp = datetime.datetime.now()
+            return
+        # Both orjson.loads and json.loads accept str and bytes.
+        # TODO(strager): What should we do on JSON parse error?
+        await self._handle_json_message(_json.loads(message))
+
+    async def _handle_json_message(self, message) -> None:
         with self._lock:
             self._last_received_message_timestamp = datetime.datetime.now()
         message_type = message["metadata"]["message_type"]
         if message_type == "session_welcome":
             session_id = message['payload']['session']['id']
-            with self._lock:
-                subscriptions = list(self._subscriptions)
-            for subscription in subscriptions:
-                self._twitch.request_eventsub_subscription({
-                    "type": subscription.type,
-                    "version": subscription.version,
-                    "condition": subscription.condition,
-                    "transport": {
-                        "method": "websocket",
-                        "session_id": session_id,
-                    },
-                })
+            transport = {
+                "method": "websocket",
+                "session_id": session_id,
+            }
+            # Subscribe concurrently so that the time to subscribe is one
+            # round trip, not one per subscription.
+            try:
+                await asyncio.gather(*(
+                    asyncio.to_thread(self._twitch.request_eventsub_subscription, {**template, "transport": transport})
+                    for template in self._subscription_request_body_templates
+                ))
+            except requests.RequestException as e:
+                raise _SubscriptionRequestError() from e
+            # Only a fully subscribed session counts as a successful
+            # connection for backoff purposes.
+            self._consecutive_failures = 0
         elif message_type == "notification":
             payload = message["payload"]
             subscription = payload["subscription"]
-            self._delegate.on_eventsub_notification(
+            await asyncio.to_thread(
+                self._delegate.on_eventsub_notification,
                 subscription_type=subscription["type"],
                 subscription_version=subscription["version"],
                 event_data=payload["event"],
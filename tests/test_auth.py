@@ -1,9 +1,12 @@
 from datetime import datetime, timezone
+import asyncio
+import json
 import responses
+import sqlite3
 import threading
 import time
 import pytest
-from first.authdb import TwitchAuthDb, TwitchAuthDbUserTokenProvider
+from first.authdb import AsyncTwitchAuthDb, TwitchAuthDb, TwitchAuthDbUserTokenProvider
 from first.errors import UserNotFoundError
 import urllib.parse
 import first.config
@@ -126,7 +129,55 @@ def test_get_all_user_ids():
             access_token="a333",
             refresh_token="r333"
     )
-    assert sorted(authdb.get_all_user_ids_slow()) == ["100", "333"]
+    assert sorted(authdb.get_all_user_ids()) == ["100", "333"]
+    assert sorted(authdb.iter_user_ids()) == ["100", "333"]
+
+def test_update_or_create_many_users():
+    authdb = TwitchAuthDb(":memory:")
+    authdb.update_or_create_user(
+            user_id="100",
+            access_token="a100",
+            refresh_token="r100"
+    )
+    authdb.update_or_create_users([
+        ("100", "new_a100", "new_r100"),
+        ("333", "a333", "r333"),
+    ])
+    assert sorted(authdb.get_all_user_ids()) == ["100", "333"]
+    assert authdb.get_access_token(user_id="100") == "new_a100"
+    assert authdb.get_refresh_token(user_id="100") == "new_r100"
+    assert authdb.get_access_token(user_id="333") == "a333"
+    assert authdb.get_refresh_token(user_id="333") == "r333"
+
+def test_async_authdb_reads_and_writes():
+    authdb = TwitchAuthDb(":memory:")
+    async_authdb = AsyncTwitchAuthDb(authdb)
+    async def run() -> None:
+        await async_authdb.update_or_create_user(user_id="5", access_token="a5", refresh_token="r5")
+        assert await async_authdb.get_access_token(user_id="5") == "a5"
+        assert await async_authdb.get_refresh_token(user_id="5") == "r5"
+        assert await async_authdb.get_all_user_ids() == ["5"]
+        assert await async_authdb.swap_tokens(user_id="5", old_refresh_token="r5", new_access_token="new_a5", new_refresh_token="new_r5")
+        assert not await async_authdb.swap_tokens(user_id="5", old_refresh_token="r5", new_access_token="newer_a5", new_refresh_token="newer_r5")
+        assert await async_authdb.get_access_token(user_id="5") == "new_a5"
+        with pytest.raises(UserNotFoundError):
+            await async_authdb.get_access_token(user_id="42")
+    asyncio.run(run())
+
+def test_swap_tokens_replaces_tokens_if_refresh_token_matches():
+    authdb = TwitchAuthDb(":memory:")
+    authdb.update_or_create_user(user_id="5", access_token="a5", refresh_token="r5")
+    assert authdb.swap_tokens(user_id="5", old_refresh_token="r5", new_access_token="new_a5", new_refresh_token="new_r5")
+    assert authdb.get_access_token(user_id="5") == "new_a5"
+    assert authdb.get_refresh_token(user_id="5") == "new_r5"
+
+def test_swap_tokens_does_nothing_if_refresh_token_changed():
+    authdb = TwitchAuthDb(":memory:")
+    authdb.update_or_create_user(user_id="5", access_token="a5", refresh_token="r5")
+    assert not authdb.swap_tokens(user_id="5", old_refresh_token="stale_r5", new_access_token="new_a5", new_refresh_token="new_r5")
+    assert authdb.get_access_token(user_id="5") == "a5"
+    assert authdb.get_refresh_token(user_id="5") == "r5"
+    assert not authdb.swap_tokens(user_id="42", old_refresh_token="r5", new_access_token="new_a5", new_refresh_token="new_r5")
 
 def test_read_and_write_from_multiple_threads():
     authdb = TwitchAuthDb(":memory:")
@@ -178,6 +229,18 @@ def test_token_provider_gives_token_from_database():
     token_provider = TwitchAuthDbUserTokenProvider(authdb, user_id="5")
     assert token_provider.get_access_token() == "my_access_token"
 
+def test_token_provider_caches_access_token():
+    authdb = TwitchAuthDb(":memory:")
+    authdb.update_or_create_user(
+            user_id="5",
+            access_token="my_access_token",
+            refresh_token="my_refresh_token"
+    )
+    token_provider = TwitchAuthDbUserTokenProvider(authdb, user_id="5")
+    assert token_provider.get_access_token() == "my_access_token"
+    authdb.update_or_create_user(user_id="5", access_token="changed_access_token", refresh_token="changed_refresh_token")
+    assert token_provider.get_access_token() == "my_access_token"
+
 @responses.activate
 def test_token_provider_refresh_gets_new_access_and_access_tokens_from_twitch_api():
     responses.post(
@@ -212,3 +275,159 @@ def test_token_provider_refresh_gets_new_access_and_access_tokens_from_twitch_ap
 
     assert authdb.get_access_token(user_id="5") == "new_access_token"
     assert authdb.get_refresh_token(user_id="5") == "new_refresh_token"
+
+def test_file_database_reads_see_committed_writes(tmp_path):
+    authdb = TwitchAuthDb(str(tmp_path / "auth.db"))
+    authdb.update_or_create_user(user_id="5", access_token="a5", refresh_token="r5")
+    assert authdb.get_access_token(user_id="5") == "a5"
+    assert authdb.get_refresh_token(user_id="5") == "r5"
+    assert authdb.get_all_user_ids() == ["5"]
+    authdb.get_created_at_time(user_id="5")
+
+    authdb.update_or_create_user(user_id="5", access_token="new_a5", refresh_token="new_r5")
+    assert authdb.get_access_token(user_id="5") == "new_a5"
+
+def test_file_database_reads_do_not_wait_for_write_lock(tmp_path):
+    authdb = TwitchAuthDb(str(tmp_path / "auth.db"))
+    authdb.update_or_create_user(user_id="5", access_token="a5", refresh_token="r5")
+
+    loaded_access_token = None
+    def reader() -> None:
+        nonlocal loaded_access_token
+        loaded_access_token = authdb.get_access_token(user_id="5")
+
+    with authdb._lock:
+        thread = threading.Thread(target=reader)
+        thread.start()
+        thread.join(timeout=3)
+        assert not thread.is_alive(), "reader blocked on the writer lock"
+    assert loaded_access_token == "a5"
+
+def test_file_database_uses_write_ahead_log(tmp_path):
+    authdb = TwitchAuthDb(str(tmp_path / "auth.db"))
+    journal_mode, = authdb.db.execute("PRAGMA journal_mode").fetchone()
+    assert journal_mode == "wal"
+
+def test_old_database_is_migrated(tmp_path):
+    path = str(tmp_path / "auth.db")
+    old_db = sqlite3.connect(path)
+    old_db.execute(
+        "CREATE TABLE twitch_tokens("
+            "user_id UNIQUE, "
+            "access_token, "
+            "refresh_token, "
+            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+            "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ")"
+    )
+    old_db.execute("INSERT INTO twitch_tokens (user_id, access_token, refresh_token, created_at, updated_at) VALUES ('5', 'a5', 'r5', '2023-07-13 11:49:36', '2023-07-14 08:00:00')")
+    old_db.commit()
+    old_db.close()
+
+    authdb = TwitchAuthDb(path)
+    assert authdb.get_access_token(user_id="5") == "a5"
+    assert authdb.get_refresh_token(user_id="5") == "r5"
+    primary_keys = [name for _cid, name, _type, _notnull, _dflt_value, pk in authdb.db.execute("PRAGMA table_info(twitch_tokens)") if pk]
+    assert primary_keys == ["user_id"]
+    assert_user_id_lookup_uses_table_primary_key(authdb)
+    assert authdb.get_created_at_time(user_id="5") == datetime(2023, 7, 13, 11, 49, 36, tzinfo=timezone.utc)
+    assert authdb.get_updated_at_time(user_id="5") == datetime(2023, 7, 14, 8, 0, 0, tzinfo=timezone.utc)
+
+    authdb.update_or_create_user(user_id="5", access_token="new_a5", refresh_token="new_r5")
+    assert authdb.get_access_token(user_id="5") == "new_a5"
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    path = str(tmp_path / "auth.db")
+    old_db = sqlite3.connect(path, timeout=0)
+    old_db.execute(
+        "CREATE TABLE twitch_tokens("
+            "user_id UNIQUE, "
+            "access_token, "
+            "refresh_token, "
+            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+            "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ")"
+    )
+    # 'user_id UNIQUE' has no affinity, so 5 and '5' are distinct. They
+    # collide in the migrated TEXT column.
+    old_db.execute("INSERT INTO twitch_tokens (user_id, access_token, refresh_token) VALUES (5, 'a5', 'r5')")
+    old_db.execute("INSERT INTO twitch_tokens (user_id, access_token, refresh_token) VALUES ('5', 'other_a5', 'other_r5')")
+    old_db.commit()
+
+    # exc_info keeps the failed TwitchAuthDb (and its connection) alive.
+    with pytest.raises(sqlite3.IntegrityError) as exc_info:
+        TwitchAuthDb(path)
+
+    # If the failed connection still held its transaction, this would raise
+    # "database is locked".
+    old_db.execute("INSERT INTO twitch_tokens (user_id, access_token, refresh_token) VALUES ('6', 'a6', 'r6')")
+    old_db.commit()
+    tables = sorted(name for (name,) in old_db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    assert tables == ["twitch_tokens"]
+    assert old_db.execute("SELECT COUNT(*) FROM twitch_tokens").fetchone() == (3,)
+    old_db.close()
+
+def test_user_id_lookup_uses_table_primary_key():
+    authdb = TwitchAuthDb(":memory:")
+    assert_user_id_lookup_uses_table_primary_key(authdb)
+
+def test_rowid_table_with_user_id_primary_key_is_migrated(tmp_path):
+    path = str(tmp_path / "auth.db")
+    old_db = sqlite3.connect(path)
+    old_db.execute(
+        "CREATE TABLE twitch_tokens("
+            "user_id TEXT PRIMARY KEY NOT NULL, "
+            "access_token, "
+            "refresh_token, "
+            "created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)), "
+            "updated_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))"
+        ")"
+    )
+    old_db.execute("INSERT INTO twitch_tokens (user_id, access_token, refresh_token, created_at, updated_at) VALUES ('5', 'a5', 'r5', 1689248976, 1689321600)")
+    old_db.commit()
+    old_db.close()
+
+    authdb = TwitchAuthDb(path)
+    assert_user_id_lookup_uses_table_primary_key(authdb)
+    assert authdb.get_access_token(user_id="5") == "a5"
+    assert authdb.get_created_at_time(user_id="5") == datetime(2023, 7, 13, 11, 49, 36, tzinfo=timezone.utc)
+
+def assert_user_id_lookup_uses_table_primary_key(authdb: TwitchAuthDb) -> None:
+    index_names = [name for (name,) in authdb.db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'twitch_tokens'")]
+    assert "sqlite_autoindex_twitch_tokens_1" not in index_names
+    plan = [detail for _id, _parent, _notused, detail in authdb.db.execute("EXPLAIN QUERY PLAN " + TwitchAuthDb._SQL_GET_ACCESS_TOKEN, ("5",))]
+    assert plan == ["SEARCH twitch_tokens USING PRIMARY KEY (user_id=?)"]
+
+@responses.activate
+def test_token_provider_refresh_uses_database_tokens_if_refreshed_concurrently():
+    authdb = TwitchAuthDb(":memory:")
+    authdb.update_or_create_user(
+            user_id="5",
+            access_token="original_access_token",
+            refresh_token="original_refresh_token"
+    )
+    token_provider = TwitchAuthDbUserTokenProvider(authdb, user_id="5")
+
+    def refresh_callback(request):
+        # Another provider finishes refreshing while our request is in flight.
+        authdb.update_or_create_user(
+                user_id="5",
+                access_token="concurrent_access_token",
+                refresh_token="concurrent_refresh_token"
+        )
+        return (200, {}, json.dumps({
+            'access_token': 'our_access_token',
+            'expires_in': 15578,
+            'refresh_token': 'our_refresh_token',
+            'scope': ['channel:manage:redemptions', 'channel:read:redemptions', 'chat:edit'],
+            'token_type': 'bearer',
+        }))
+    responses.add_callback(responses.POST, "https://id.twitch.tv/oauth2/token", callback=refresh_callback)
+
+    assert token_provider.refresh_access_token() == "concurrent_access_token"
+    assert authdb.get_access_token(user_id="5") == "concurrent_access_token"
+    assert authdb.get_refresh_token(user_id="5") == "concurrent_refresh_token"
+
+    # The cached token should be the database's, not ours.
+    authdb.update_or_create_user(user_id="5", access_token="later_access_token", refresh_token="later_refresh_token")
+    assert token_provider.get_access_token() == "concurrent_access_token"
@@ -1,15 +1,20 @@
 from first.authdb import Token, TokenProvider
 from first.pointsdb import PointsDb
 from first.twitch import AuthenticatedTwitch
-from first.twitch_eventsub import TwitchEventSubWebSocketThread, TwitchEventSubDelegate
+from first.twitch_eventsub import TwitchEventSubWebSocketThread, TwitchEventSubDelegate, stub_twitch_eventsub_delegate
 from first.web_server import PointsDbTwitchEventSubDelegate
 from first.accountdb import FirstAccountDb
 from first.authdb import TwitchAuthDb
+import asyncio
 import contextlib
+import first.twitch_eventsub
 import copy
 import json
+import logging
 import pytest
+import requests
 import threading
+import time
 import typing
 import websockets.sync.server
 
@@ -123,6 +128,272 @@ def test_eventsub_thread_calls_delegate_on_receiving_channel_point_redemption(ex
         assert received_event_data.get("reward", {}).get("id") == "b34cd9ba-40de-4953-80f8-57362376f8e0"
         assert received_event_data.get("redeemed_at") == "2023-07-13T11:49:36.525368238Z"
 
+def test_eventsub_stop_thread_interrupts_idle_connection(exit_stack):
+    # Create a server which accepts a connection then sends nothing.
+    server_connected = threading.Event()
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        server_connected.set()
+        for _message in connection:
+            pass
+
+    server = exit_stack.enter_context(websockets.sync.server.serve(handle_server_connection, host="localhost", port=0))
+    server_thread = threading.Thread(target=server.serve_forever)
+    exit_stack.callback(lambda: server_thread.join())
+    exit_stack.callback(lambda: server.shutdown())
+    server_thread.start()
+    (server_host, server_port) = server.socket.getsockname()
+
+    twitch = AuthenticatedTwitch(FailingTokenProvider())
+    client_thread = TwitchEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=f"ws://{server_host}:{server_port}/")
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={})
+    client_thread.start_thread()
+    assert server_connected.wait(timeout=3), "timed out waiting for client to connect"
+
+    stopper = threading.Thread(target=client_thread.stop_thread)
+    stopper.start()
+    stopper.join(timeout=3)
+    assert not stopper.is_alive(), "stop_thread did not interrupt the connection"
+
+def test_eventsub_welcome_requests_all_subscriptions_concurrently(exit_stack):
+    # Create a server which welcomes the client.
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        connection.send(json.dumps({
+          "metadata": {
+            "message_id": "96a3f3b5-5dec-4eed-908e-e11ee657416c",
+            "message_type": "session_welcome",
+            "message_timestamp": "2023-07-19T14:56:51.634234626Z"
+          },
+          "payload": {
+            "session": {
+              "id": "AQoQILE98gtqShGmLD7AM6yJThAB",
+              "status": "connected",
+              "connected_at": "2023-07-19T14:56:51.616329898Z",
+              "keepalive_timeout_seconds": 10,
+              "reconnect_url": None
+            }
+          }
+        }))
+        for _message in connection:
+            pass
+
+    server = exit_stack.enter_context(websockets.sync.server.serve(handle_server_connection, host="localhost", port=0))
+    server_thread = threading.Thread(target=server.serve_forever)
+    exit_stack.callback(lambda: server_thread.join())
+    exit_stack.callback(lambda: server.shutdown())
+    server_thread.start()
+    (server_host, server_port) = server.socket.getsockname()
+
+    # Each request waits until both requests are in flight, so requests
+    # issued one after the other would time out.
+    requests_in_flight = threading.Barrier(2, timeout=3)
+    requested_bodies_lock = threading.Lock()
+    requested_bodies = []
+    class FakeTwitch(AuthenticatedTwitch):
+        def request_eventsub_subscription(self, request_body) -> None:
+            requests_in_flight.wait()
+            with requested_bodies_lock:
+                requested_bodies.append(request_body)
+
+    twitch = FakeTwitch(FailingTokenProvider())
+    client_thread = TwitchEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=f"ws://{server_host}:{server_port}/")
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={"broadcaster_user_id": "1"})
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={"broadcaster_user_id": "2"})
+    exit_stack.callback(lambda: client_thread.stop_thread())
+    client_thread.start_thread()
+
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        with requested_bodies_lock:
+            if len(requested_bodies) == 2:
+                break
+        time.sleep(0.01)
+    with requested_bodies_lock:
+        assert sorted(body["condition"]["broadcaster_user_id"] for body in requested_bodies) == ["1", "2"]
+        for body in requested_bodies:
+            assert body["transport"] == {"method": "websocket", "session_id": "AQoQILE98gtqShGmLD7AM6yJThAB"}
+
+def test_eventsub_thread_accepts_binary_messages():
+    received_event_data = []
+    class TestClientDelegate(TwitchEventSubDelegate):
+        def on_eventsub_notification(self,
+                                     subscription_type: str,
+                                     subscription_version: str,
+                                     event_data: typing.Dict[str, typing.Any]) -> None:
+            received_event_data.append(event_data)
+
+    twitch = AuthenticatedTwitch(FailingTokenProvider())
+    client_thread = TwitchEventSubWebSocketThread(twitch, TestClientDelegate())
+    message = json.dumps({
+        "metadata": {"message_type": "notification"},
+        "payload": {
+            "subscription": {"type": "channel.channel_points_custom_reward_redemption.add", "version": "1"},
+            "event": {"user_id": "21065580"},
+        },
+    })
+    asyncio.run(client_thread._handle_raw_message(message.encode("utf-8")))
+    assert received_event_data == [{"user_id": "21065580"}]
+
+def test_eventsub_reconnect_delay_grows_when_server_keeps_disconnecting(exit_stack):
+    # Create a server which immediately disconnects every client.
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        pass
+    websocket_uri = start_websocket_server(exit_stack, handle_server_connection)
+
+    twitch = AuthenticatedTwitch(FailingTokenProvider())
+    client_thread = DelayRecordingEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=websocket_uri)
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={})
+    exit_stack.callback(lambda: client_thread.stop_thread())
+    client_thread.start_thread()
+
+    assert client_thread.recorded_all_delays.wait(timeout=3), "timed out waiting for reconnects"
+    assert_exponential_delays(client_thread.recorded_delays)
+
+def test_eventsub_reconnect_delay_grows_when_subscription_requests_fail(exit_stack):
+    # Create a server which welcomes every client.
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        connection.send(json.dumps({
+          "metadata": {"message_type": "session_welcome"},
+          "payload": {"session": {"id": "AQoQILE98gtqShGmLD7AM6yJThAB"}},
+        }))
+        for _message in connection:
+            pass
+    websocket_uri = start_websocket_server(exit_stack, handle_server_connection)
+
+    class FailingTwitch(AuthenticatedTwitch):
+        def request_eventsub_subscription(self, request_body) -> None:
+            raise requests.ConnectionError("simulated Twitch API outage")
+
+    twitch = FailingTwitch(FailingTokenProvider())
+    client_thread = DelayRecordingEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=websocket_uri)
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={})
+    exit_stack.callback(lambda: client_thread.stop_thread())
+    client_thread.start_thread()
+
+    assert client_thread.recorded_all_delays.wait(timeout=3), "timed out waiting for reconnects"
+    assert_exponential_delays(client_thread.recorded_delays)
+
+def test_eventsub_reconnect_delay_resets_after_subscribing(exit_stack):
+    # Create a server which welcomes every client then disconnects it.
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        connection.send(json.dumps({
+          "metadata": {"message_type": "session_welcome"},
+          "payload": {"session": {"id": "AQoQILE98gtqShGmLD7AM6yJThAB"}},
+        }))
+        # Wait for the subscription request to finish before disconnecting.
+        subscribed.wait(timeout=3)
+        subscribed.clear()
+    websocket_uri = start_websocket_server(exit_stack, handle_server_connection)
+
+    subscribed = threading.Event()
+    class SucceedingTwitch(AuthenticatedTwitch):
+        def request_eventsub_subscription(self, request_body) -> None:
+            subscribed.set()
+
+    twitch = SucceedingTwitch(FailingTokenProvider())
+    client_thread = DelayRecordingEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=websocket_uri)
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={})
+    exit_stack.callback(lambda: client_thread.stop_thread())
+    client_thread.start_thread()
+
+    assert client_thread.recorded_all_delays.wait(timeout=3), "timed out waiting for reconnects"
+    for delay in client_thread.recorded_delays:
+        assert 1 <= delay < 2
+
+class DelayRecordingEventSubWebSocketThread(TwitchEventSubWebSocketThread):
+    """Records the backoff delays it computes, but reconnects immediately."""
+
+    RECORDED_DELAY_COUNT = 4
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Accessed only by the task until recorded_all_delays is set.
+        self.recorded_delays = []
+        self.recorded_all_delays = threading.Event()
+
+    def _next_reconnect_delay_seconds(self) -> float:
+        if self.recorded_all_delays.is_set():
+            # Wait for stop_thread.
+            return 60
+        self.recorded_delays.append(super()._next_reconnect_delay_seconds())
+        if len(self.recorded_delays) == self.RECORDED_DELAY_COUNT:
+            self.recorded_all_delays.set()
+        return 0
+
+def assert_exponential_delays(delays: typing.List[float]) -> None:
+    assert len(delays) == DelayRecordingEventSubWebSocketThread.RECORDED_DELAY_COUNT
+    for (i, delay) in enumerate(delays):
+        # 2**i seconds plus less than a second of jitter.
+        assert 2 ** i <= delay < 2 ** i + 1, f"delay {i} should be about {2 ** i} seconds, but is {delay}"
+
+def start_websocket_server(exit_stack, handle_server_connection) -> str:
+    """Serve WebSockets on localhost until exit_stack closes.
+
+    Returns the server's URI.
+    """
+    server = exit_stack.enter_context(websockets.sync.server.serve(handle_server_connection, host="localhost", port=0))
+    server_thread = threading.Thread(target=server.serve_forever)
+    exit_stack.callback(lambda: server_thread.join())
+    exit_stack.callback(lambda: server.shutdown())
+    server_thread.start()
+    (server_host, server_port) = server.socket.getsockname()
+    return f"ws://{server_host}:{server_port}/"
+
+@pytest.mark.parametrize("message", [
+    # Twitch sends compact JSON:
+    '{"metadata":{"message_id":"84c1e79a-2a4b-4c13-ba0b-4312293e9308","message_type":"session_keepalive","message_timestamp":"2023-07-19T10:11:12.634234626Z"},"payload":{}}',
+    b'{"metadata":{"message_id":"84c1e79a-2a4b-4c13-ba0b-4312293e9308","message_type":"session_keepalive","message_timestamp":"2023-07-19T10:11:12.634234626Z"},"payload":{}}',
+])
+def test_eventsub_thread_handles_keepalive_without_parsing_json(message, monkeypatch):
+    class FailingJson:
+        @staticmethod
+        def loads(message):
+            raise AssertionError("should not be called")
+    monkeypatch.setattr(first.twitch_eventsub, "_json", FailingJson)
+
+    twitch = AuthenticatedTwitch(FailingTokenProvider())
+    client_thread = TwitchEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate)
+    assert client_thread.last_received_message_timestamp is None
+    asyncio.run(client_thread._handle_raw_message(message))
+    assert client_thread.last_received_message_timestamp is not None
+
+def test_eventsub_subscription_request_failure_is_not_logged_as_connection_failure(exit_stack, caplog):
+    # Create a server which welcomes the client.
+    def handle_server_connection(connection: websockets.sync.server.ServerConnection) -> None:
+        connection.send(json.dumps({
+          "metadata": {"message_type": "session_welcome"},
+          "payload": {"session": {"id": "AQoQILE98gtqShGmLD7AM6yJThAB"}},
+        }))
+        for _message in connection:
+            pass
+
+    server = exit_stack.enter_context(websockets.sync.server.serve(handle_server_connection, host="localhost", port=0))
+    server_thread = threading.Thread(target=server.serve_forever)
+    exit_stack.callback(lambda: server_thread.join())
+    exit_stack.callback(lambda: server.shutdown())
+    server_thread.start()
+    (server_host, server_port) = server.socket.getsockname()
+
+    class FailingTwitch(AuthenticatedTwitch):
+        def request_eventsub_subscription(self, request_body) -> None:
+            raise requests.ConnectionError("simulated Twitch API outage")
+
+    caplog.set_level(logging.INFO, logger="first.twitch_eventsub")
+    twitch = FailingTwitch(FailingTokenProvider())
+    client_thread = TwitchEventSubWebSocketThread(twitch, stub_twitch_eventsub_delegate, websocket_uri=f"ws://{server_host}:{server_port}/")
+    client_thread.add_subscription(type="channel.channel_points_custom_reward_redemption.add", version="1", condition={})
+    exit_stack.callback(lambda: client_thread.stop_thread())
+    client_thread.start_thread()
+
+    def logged_messages() -> typing.List[str]:
+        return [record.getMessage() for record in caplog.records]
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        if "failed to request EventSub subscriptions; reconnecting" in logged_messages():
+            break
+        time.sleep(0.01)
+    assert "failed to request EventSub subscriptions; reconnecting" in logged_messages()
+    assert "failed to connect to EventSub" not in logged_messages()
+
 @pytest.mark.skip(reason="time")
 def test_eventsub_delegate_stores_data_in_pointsdb():
     points_db = PointsDb(":memory:")